@@ -1,13 +1,20 @@
-import yaml
-import json
+import asyncio
+import orjson
+import os
 import re
 from typing import List, Dict
 
 import ollama
 
+from utils.aio import run_sync
 from utils.history import History
+from utils.prompts import load_prompts
 from dataset.dataset import BeerDataset
 
+# Compiled once; fallback when the brace scan finds nothing balanced
+# (e.g. a brace inside a string literal throws the depth count off)
+_JSON_OBJ_RE = re.compile(r"\{.*\}", re.DOTALL)
+
 
 class StateTracker:
     def __init__(self, intent: str):
@@ -17,6 +24,7 @@ class StateTracker:
         """
         self.intent = intent
         self.slots = self._initialize_slots(intent)
+        self._serialized_cache: str | None = None
 
     def _initialize_slots(self, intent: str) -> Dict[str, str | None]:
         intent_slots = {
@@ -36,58 +44,126 @@ class StateTracker:
             if isinstance(value, dict):
                 for slot, val in value.items():
                     self.slots[slot] = None if val in ["null", None] else val
+        self._serialized_cache = None
         return self.serialize()
 
     def serialize(self) -> str:
-        safe = {k: (v if v is not None else "null") for k, v in self.slots.items()}
-        return json.dumps({"intent": self.intent, "slots": safe}, indent=2)
+        # Serialized once per update; the DM re-reads the state every turn.
+        # Compact form — indentation is just extra tokens for the LLM.
+        if self._serialized_cache is None:
+            safe = {k: (v if v is not None else "null") for k, v in self.slots.items()}
+            self._serialized_cache = orjson.dumps({"intent": self.intent, "slots": safe}).decode()
+        return self._serialized_cache
 
     def get_intent(self) -> str:
         return self.intent
 
 
 class DM:
-    def __init__(self, model: str, prompt_path: str, eval_mode: bool = False):
+    # Past this size batched requests hit diminishing returns
+    BATCH_LIMIT = 8
+
+    def __init__(self, model: str, prompt_path: str, eval_mode: bool = False,
+                 client: ollama.AsyncClient | None = None,
+                 sync_client: ollama.Client | None = None):
         """
         Decides next actions based on slot states and intent type.
+        Shared ollama clients may be injected; own ones are created otherwise.
         """
         self.model = model
         self.eval_mode = eval_mode
+        # Persistent clients pinned to one host: requests reuse the same HTTP
+        # connection instead of paying a TCP handshake per call
+        host = os.environ.get("OLLAMA_HOST", "http://localhost:11434")
+        self.client = client or ollama.AsyncClient(host=host)
+        self.sync_client = sync_client or ollama.Client(host=host)
         self.dataset = BeerDataset()
         self.history = History()
         self.history.history_limit = 6
         self.prompts = self._load_prompts(prompt_path)
         self.state_stack: List[StateTracker] = []
+        self._state_by_intent: Dict[str, StateTracker] = {}
+
+        # Guided decoding: the server only emits decisions matching these
+        # schemas, so malformed-JSON retries (each one a full LLM call) go away
+        decision = {
+            "type": "object",
+            "properties": {
+                "action": {"type": "string", "enum": ["request_info", "confirmation"]},
+                "parameter": {"type": "string"}
+            },
+            "required": ["action", "parameter"]
+        }
+        self._format_schema = decision
+        self._format_schema_batch = {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": dict(decision["properties"], id={"type": "integer"}),
+                "required": ["id", "action", "parameter"]
+            }
+        }
 
     def _load_prompts(self, path: str) -> Dict:
-        with open(path, "r") as f:
-            return yaml.safe_load(f)
+        return load_prompts(path)
+
+    def warmup_prefix(self) -> None:
+        """
+        Pre-fills the server-side KV cache for the static system prompt,
+        so later calls only pay for the user suffix.
+        """
+        try:
+            self.sync_client.chat(
+                model=self.model,
+                messages=[
+                    {"role": "system", "content": self.prompts["dm"]["prompt"]},
+                    {"role": "user", "content": "."}
+                ],
+                options={"num_predict": 1},
+                keep_alive=-1
+            )
+        except Exception:
+            # Best-effort: the server may not be reachable yet
+            pass
 
     def __call__(self, nlu_inputs: List[Dict]) -> List[Dict]:
+        return run_sync(self.acall(nlu_inputs))
+
+    async def acall(self, nlu_inputs: List[Dict],
+                    state_stack: List[StateTracker] | None = None,
+                    state_by_intent: Dict[str, StateTracker] | None = None) -> List[Dict]:
+        """
+        Async variant of __call__, so independent callers (e.g. evaluation)
+        can keep several decision requests in flight at once. Callers may
+        pass their own state containers for an isolated conversation; by
+        default the component's own conversation state is used.
+        """
         if len(nlu_inputs) == 1 and nlu_inputs[0].get("intent") == "terminate_system":
             return ["terminate_system"]
 
-        self.state_stack = self._update_states(nlu_inputs)
+        own_state = state_stack is None
+        if own_state:
+            state_stack = self.state_stack
+            state_by_intent = self._state_by_intent
 
-        final_actions = []
-        remove_indices = []
+        states = self._update_states(nlu_inputs, state_stack, state_by_intent)
 
-        for idx, state in enumerate(self.state_stack):
-            state_str = state.serialize()
-            repeat = True
+        # States share the DM prompt, so several fit one batched request;
+        # anything the batch misses falls back to a per-state call
+        if len(states) > 1:
+            parsed_actions = await self._infer_actions_batch(states)
+        else:
+            tasks = [self._infer_action(state) for state in states]
+            parsed_actions = await asyncio.gather(*tasks)
 
-            while repeat:
-                model_reply = self._query_model(state_str)
-                try:
-                    parsed = json.loads(self._extract_json(model_reply))
-                except:
-                    print(f"[DM] Retry on invalid JSON: {model_reply}")
-                    continue
+        final_actions = []
+        remove_indices = []
 
-                repeat = not self._check_response_validity(parsed, state) if not self.eval_mode else False
+        for idx, (state, parsed) in enumerate(zip(states, parsed_actions)):
+            result = None
 
             if parsed["action"] == "confirmation":
-                result = self._handle_confirmation(parsed)
+                result = self._handle_confirmation(parsed, state_by_intent)
                 if result:
                     remove_indices.append(idx)
                 else:
@@ -103,42 +179,127 @@ class DM:
                 "data": result
             })
 
-        self.state_stack = [s for i, s in enumerate(self.state_stack) if i not in remove_indices]
+        for i in remove_indices:
+            state_by_intent.pop(states[i].get_intent(), None)
+        remaining = [s for i, s in enumerate(states) if i not in remove_indices]
+        if own_state:
+            self.state_stack = remaining
+        else:
+            state_stack[:] = remaining
         return final_actions
 
-    def _update_states(self, nlu_inputs: List[Dict]) -> List[StateTracker]:
+    @staticmethod
+    def _update_states(nlu_inputs: List[Dict], state_stack: List[StateTracker],
+                       state_by_intent: Dict[str, StateTracker]) -> List[StateTracker]:
         for nlu in nlu_inputs:
             intent = nlu["intent"]
-            found = False
-            for state in self.state_stack:
-                if state.get_intent() == intent:
-                    state.update(nlu)
-                    found = True
-                    break
-            if not found:
+            state = state_by_intent.get(intent)
+            if state is not None:
+                state.update(nlu)
+            else:
                 new_state = StateTracker(intent)
                 new_state.update(nlu)
-                self.state_stack.append(new_state)
-        return self.state_stack
+                state_stack.append(new_state)
+                state_by_intent[intent] = new_state
+        return state_stack
+
+    async def _infer_actions_batch(self, states: List[StateTracker]) -> List[Dict]:
+        parsed_actions: List[Dict | None] = [None] * len(states)
+
+        for start in range(0, len(states), self.BATCH_LIMIT):
+            batch = states[start:start + self.BATCH_LIMIT]
+            payload = [
+                dict(orjson.loads(state.serialize()), id=start + i)
+                for i, state in enumerate(batch)
+            ]
+
+            model_reply = await self._aquery_model(orjson.dumps(payload).decode(), batch=True)
+            try:
+                items = orjson.loads(model_reply)
+            except:
+                print(f"[DM] Invalid batch JSON, falling back: {model_reply}")
+                continue
+
+            for item in items if isinstance(items, list) else []:
+                idx = item.get("id")
+                if not isinstance(idx, int) or not (start <= idx < start + len(batch)):
+                    continue
+                parsed = {"action": item.get("action"), "parameter": item.get("parameter")}
+                if self.eval_mode or self._check_response_validity(parsed, states[idx]):
+                    parsed_actions[idx] = parsed
+
+        # Re-ask individually for anything the batch got wrong
+        missing = [i for i, parsed in enumerate(parsed_actions) if parsed is None]
+        if missing:
+            retried = await asyncio.gather(*[self._infer_action(states[i]) for i in missing])
+            for i, parsed in zip(missing, retried):
+                parsed_actions[i] = parsed
+
+        return parsed_actions
+
+    async def _infer_action(self, state: StateTracker) -> Dict:
+        state_str = state.serialize()
+
+        while True:
+            model_reply = await self._aquery_model(state_str)
+            try:
+                parsed = orjson.loads(model_reply)
+            except:
+                # Guided decoding makes this near-impossible; the balanced
+                # scan is a last-resort salvage, not another LLM call
+                try:
+                    parsed = orjson.loads(self._extract_json(model_reply))
+                except:
+                    print(f"[DM] Invalid JSON: {model_reply}")
+                    parsed = {"action": "request_info", "parameter": None}
 
-    def _query_model(self, user_payload: str) -> str:
+            # Only semantically invalid decisions trigger another call
+            if self.eval_mode or self._check_response_validity(parsed, state):
+                return parsed
+
+    async def _aquery_model(self, user_payload: str, batch: bool = False) -> str:
         system_prompt = self.prompts["dm"]["prompt"]
 
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_payload}
-        ]
+        messages = [{"role": "system", "content": system_prompt}]
+
+        if batch:
+            messages.append({
+                "role": "system",
+                "content": self.prompts["dm"]["prompt_batch"]
+            })
+
+        messages.append({"role": "user", "content": user_payload})
 
-        response = ollama.chat(
+        response = await self.client.chat(
             model=self.model,
             messages=messages,
-            options={"num_predict": 200}
+            format=self._format_schema_batch if batch else self._format_schema,
+            # Each decision is a tiny {action, parameter} object; these
+            # ceilings leave ample headroom while capping worst-case decode
+            options={"num_predict": 300 if batch else 80},
+            keep_alive=-1
         )
 
         return response["message"]["content"]
 
     def _extract_json(self, text: str) -> str:
-        match = re.search(r"\{.*\}", text, re.DOTALL)
+        """
+        Extracts the first balanced JSON object via a single-pass brace scan.
+        """
+        start = text.find("{")
+        if start == -1:
+            return text
+
+        depth = 0
+        for i in range(start, len(text)):
+            if text[i] == "{":
+                depth += 1
+            elif text[i] == "}":
+                depth -= 1
+                if depth == 0:
+                    return text[start:i + 1]
+
+        match = _JSON_OBJ_RE.search(text)
         return match.group(0) if match else text
 
     def _check_response_validity(self, nba: Dict, state: StateTracker) -> bool:
@@ -163,10 +324,11 @@ class DM:
 
         return True
 
-    def _handle_confirmation(self, nba_confirm: Dict) -> str | None:
+    def _handle_confirmation(self, nba_confirm: Dict,
+                             state_by_intent: Dict[str, StateTracker]) -> str | None:
         target_intent = nba_confirm["parameter"]
 
-        target_state = next((s for s in self.state_stack if s.get_intent() == target_intent), None)
+        target_state = state_by_intent.get(target_intent)
         if not target_state:
             return None
 
@@ -1,26 +1,34 @@
-import yaml
+import orjson
+import os
 from typing import List, Dict
 
 import ollama
 
+from utils.prompts import load_prompts
+
 
 class NLG:
-    def __init__(self, model: str, prompt_path: str):
+    def __init__(self, model: str, prompt_path: str,
+                 client: ollama.Client | None = None):
         """
         Generates system responses from structured DM outputs.
 
         Args:
             model (str): LLM model name to query.
             prompt_path (str): YAML prompt definitions.
+            client: Shared sync ollama client; created when not given.
         """
         self.model = model
+        # One persistent client: requests reuse the same HTTP connection
+        # instead of paying a TCP handshake per call
+        self.client = client or ollama.Client(host=os.environ.get("OLLAMA_HOST", "http://localhost:11434"))
         self.prompts = self._load_prompts(prompt_path)
 
         # Maps (action, intent) or just action to a prompt key
         self.prompt_map = {
             "request_info": "prompt_request_info",
             "check_info": "prompt_check_info",
-            "merge": "prompt_merge_responses",
+            "render_batch": "prompt_render_batch",
             ("confirmation", "get_beer_recommendation"): "prompt_confirmation_get_beer_recommendation",
             ("confirmation", "get_beer_info"): "prompt_confirmation_get_beer_info",
             ("confirmation", "list_beers_by_brewery"): "prompt_confirmation_list_beers_by_brewery",
@@ -29,6 +37,26 @@ class NLG:
             ("confirmation", "out_of_context"): "prompt_confirmation_out_of_context"
         }
 
+    def warmup_prefix(self) -> None:
+        """
+        Pre-fills the server-side KV cache for each static system prompt,
+        so later calls only pay for the user suffix.
+        """
+        for prompt in self.prompts["nlg"].values():
+            try:
+                self.client.chat(
+                    model=self.model,
+                    messages=[
+                        {"role": "system", "content": prompt},
+                        {"role": "user", "content": "."}
+                    ],
+                    options={"num_predict": 1},
+                    keep_alive=-1
+                )
+            except Exception:
+                # Best-effort: the server may not be reachable yet
+                break
+
     def __call__(self, decisions: List[Dict]) -> str:
         """
         Converts DM actions into a final system utterance.
@@ -39,32 +67,35 @@ class NLG:
         Returns:
             str: Verbalized system response.
         """
-        responses = []
-
         for action_obj in decisions:
             if not isinstance(action_obj, dict):
                 return "error"
 
             action = action_obj["action"]
             param = action_obj["parameter"]
-            payload = action_obj["data"]
 
             key = (action, param) if (action, param) in self.prompt_map else action
-            prompt_key = self.prompt_map.get(key)
-
-            if not prompt_key:
+            if not self.prompt_map.get(key):
                 return "error"
 
-            system_prompt = self.prompts["nlg"][prompt_key]
-            response = self._query_model(action, param, payload, system_prompt)
-            responses.append(response)
+        # Multiple actions are rendered in one call: the model verbalizes and
+        # combines them at once, instead of N per-action calls plus a merge hop
+        if len(decisions) > 1:
+            return self._render_batch(decisions)
+
+        action_obj = decisions[0]
+        action = action_obj["action"]
+        param = action_obj["parameter"]
+        payload = action_obj["data"]
 
-        return responses[0] if len(responses) == 1 else self._merge_responses(responses)
+        key = (action, param) if (action, param) in self.prompt_map else action
+        system_prompt = self.prompts["nlg"][self.prompt_map[key]]
+        return self._query_model(action, param, payload, system_prompt)
 
-    def _merge_responses(self, responses: List[str]) -> str:
-        prompt = self.prompts["nlg"][self.prompt_map["merge"]]
-        combined = "\n\n".join([f"response {i+1}: {text}" for i, text in enumerate(responses)])
-        return self._query_model("merge", "responses", combined, prompt)
+    def _render_batch(self, decisions: List[Dict]) -> str:
+        prompt = self.prompts["nlg"][self.prompt_map["render_batch"]]
+        combined = orjson.dumps(decisions).decode()
+        return self._query_model("render_batch", "actions", combined, prompt)
 
     def _query_model(self, action: str, param: str, data: str, prompt: str) -> str:
         messages = [
@@ -72,14 +103,14 @@ class NLG:
             {"role": "user", "content": f"action: {action}, parameter: {param}\ndata = {data}"}
         ]
 
-        response = ollama.chat(
+        response = self.client.chat(
             model=self.model,
             messages=messages,
-            options={"num_predict": 200}
+            options={"num_predict": 200},
+            keep_alive=-1
         )
 
         return response["message"]["content"]
 
     def _load_prompts(self, path: str) -> Dict:
-        with open(path, "r") as f:
-            return yaml.safe_load(f)
+        return load_prompts(path)
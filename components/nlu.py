@@ -1,15 +1,22 @@
-import json
-import yaml
-from copy import deepcopy
+import asyncio
+import orjson
+import os
 from typing import List, Dict
 
 import ollama
 
+from utils.aio import run_sync
 from utils.history import History
+from utils.prompts import load_prompts
 
 
 class NLU:
-    def __init__(self, model: str, prompt_path: str, eval_mode: bool = False):
+    # Past this size batched requests hit diminishing returns
+    BATCH_LIMIT = 8
+
+    def __init__(self, model: str, prompt_path: str, eval_mode: bool = False,
+                 client: ollama.AsyncClient | None = None,
+                 sync_client: ollama.Client | None = None):
         """
         Extracts slots from user intents using prompt-based LLM guidance.
 
@@ -17,12 +24,19 @@ class NLU:
             model (str): Model identifier to query.
             prompt_path (str): YAML path containing NLU prompts.
             eval_mode (bool): Toggles inclusion of system-user history.
+            client: Shared async ollama client; created when not given.
+            sync_client: Shared sync ollama client; created when not given.
         """
         self.model = model
         self.prompt_path = prompt_path
         self.eval_mode = eval_mode
         self.history = History()
         self.history.history_limit = 6
+        # Persistent clients pinned to one host: requests reuse the same HTTP
+        # connection instead of paying a TCP handshake per call
+        host = os.environ.get("OLLAMA_HOST", "http://localhost:11434")
+        self.client = client or ollama.AsyncClient(host=host)
+        self.sync_client = sync_client or ollama.Client(host=host)
         self.prompts = self._load_prompts()
 
         self.prompt_map = {
@@ -36,8 +50,27 @@ class NLU:
         }
 
     def _load_prompts(self) -> Dict:
-        with open(self.prompt_path, "r") as f:
-            return yaml.safe_load(f)
+        return load_prompts(self.prompt_path)
+
+    def warmup_prefix(self) -> None:
+        """
+        Pre-fills the server-side KV cache for each static system prompt,
+        so later calls only pay for the user suffix.
+        """
+        for prompt in self.prompts["nlu"].values():
+            try:
+                self.sync_client.chat(
+                    model=self.model,
+                    messages=[
+                        {"role": "system", "content": prompt},
+                        {"role": "user", "content": "."}
+                    ],
+                    options={"num_predict": 1},
+                    keep_alive=-1
+                )
+            except Exception:
+                # Best-effort: the server may not be reachable yet
+                break
 
     def __call__(self, pre_nlu_result: List[Dict], user_utterance: str, system_utterance: str) -> List[Dict]:
         """
@@ -51,36 +84,91 @@ class NLU:
         Returns:
             List[Dict]: Extracted slot structures.
         """
-        cleaned_outputs = []
+        return run_sync(self.acall(pre_nlu_result, user_utterance, system_utterance))
 
+    async def acall(self, pre_nlu_result: List[Dict], user_utterance: str, system_utterance: str) -> List[Dict]:
+        """
+        Async variant of __call__, so independent callers (e.g. evaluation)
+        can keep several slot-filling requests in flight at once.
+        """
         self.history.push("system", system_utterance)
 
+        # Chunks sharing a prompt are marshalled into one batched request
+        groups: Dict[str, List[Dict]] = {}
         for intent_chunk in pre_nlu_result:
             intent_name = intent_chunk.get("intent")
             prompt_key = self.prompt_map.get(intent_name, "prompt_out_of_context")
-            system_prompt = self.prompts["nlu"][prompt_key]
 
             # Skip give_evaluation if multi-intent detected
             if intent_name == "give_evaluation" and len(pre_nlu_result) > 1:
                 continue
 
-            while True:
-                raw_response = self._query_model(intent_chunk, system_prompt)
+            groups.setdefault(prompt_key, []).append(intent_chunk)
 
-                try:
-                    parsed = json.loads(raw_response)
-                    result = self._clean_slots(parsed)
-                    cleaned_outputs.append(result)
-                    break
-                except Exception as e:
-                    print(f"[NLU] JSON error. Retrying. Response was: {raw_response}")
+        # Groups are independent, so their slot-filling calls run concurrently
+        tasks = []
+        for prompt_key, chunks in groups.items():
+            system_prompt = self.prompts["nlu"][prompt_key]
+            if len(chunks) == 1:
+                tasks.append(self._infer_slots(chunks[0], system_prompt))
+            else:
+                for start in range(0, len(chunks), self.BATCH_LIMIT):
+                    tasks.append(self._infer_slots_batch(
+                        chunks[start:start + self.BATCH_LIMIT], system_prompt
+                    ))
+
+        cleaned_outputs = []
+        for result in await asyncio.gather(*tasks):
+            if isinstance(result, list):
+                cleaned_outputs.extend(result)
+            else:
+                cleaned_outputs.append(result)
 
         self.history.push("user", user_utterance)
         return cleaned_outputs
 
-    def _query_model(self, intent_block: Dict, system_prompt: str) -> str:
+    async def _infer_slots(self, intent_block: Dict, system_prompt: str) -> Dict:
+        raw_response = await self._aquery_model(intent_block, system_prompt)
+
+        try:
+            parsed = orjson.loads(raw_response)
+            return self._clean_slots(parsed)
+        except Exception as e:
+            # Guided decoding makes this near-impossible; degrade to an
+            # empty slot set instead of burning another LLM round-trip
+            print(f"[NLU] JSON error. Response was: {raw_response}")
+            return {"intent": intent_block.get("intent"), "slots": {}}
+
+    async def _infer_slots_batch(self, chunks: List[Dict], system_prompt: str) -> List[Dict]:
+        payload = [{"id": i, **chunk} for i, chunk in enumerate(chunks)]
+        raw_response = await self._aquery_model(payload, system_prompt, batch=True)
+
+        try:
+            parsed = orjson.loads(raw_response)
+            by_id = {item["id"]: item for item in parsed}
+
+            # Scatter results back into input order
+            results = []
+            for i in range(len(chunks)):
+                item = dict(by_id[i])
+                item.pop("id")
+                results.append(self._clean_slots(item))
+            return results
+        except Exception as e:
+            # Fall back to one single call per chunk, not a batch retry
+            print(f"[NLU] Batch JSON error. Response was: {raw_response}")
+            tasks = [self._infer_slots(chunk, system_prompt) for chunk in chunks]
+            return list(await asyncio.gather(*tasks))
+
+    async def _aquery_model(self, intent_block: Dict, system_prompt: str, batch: bool = False) -> str:
         messages = [{"role": "system", "content": system_prompt}]
 
+        if batch:
+            messages.append({
+                "role": "system",
+                "content": self.prompts["nlu"]["prompt_batch"]
+            })
+
         if self.eval_mode:
             for msg in self.history.get_history():
                 messages.append({
@@ -95,28 +183,34 @@ class NLU:
 
         messages.append({
             "role": "user",
-            "content": str(intent_block)
+            "content": orjson.dumps(intent_block).decode() if batch else str(intent_block)
         })
 
-        response = ollama.chat(
+        response = await self.client.chat(
             model=self.model,
             messages=messages,
-            options={"num_predict": 200}
+            # Guided decoding: slot schemas vary per intent, so constrain the
+            # shape (object / array of objects) rather than the fields
+            format={"type": "array", "items": {"type": "object"}} if batch else "json",
+            # Slot objects are small (~60 tokens each); these ceilings leave
+            # ample headroom while capping worst-case decode time
+            options={"num_predict": 600 if batch else 120},
+            keep_alive=-1
         )
 
         return response["message"]["content"]
 
     def _clean_slots(self, response: Dict) -> Dict:
-        cleaned = deepcopy(response)
+        cleaned = {}
 
         for key, value in response.items():
             if value is None:
                 cleaned[key] = "null"
             elif isinstance(value, dict):
-                nested = self._clean_slots(deepcopy(value))
-                if len(nested) == 0:
-                    del cleaned[key]
-                else:
+                nested = self._clean_slots(value)
+                if nested:
                     cleaned[key] = nested
+            else:
+                cleaned[key] = value
 
         return cleaned
@@ -1,16 +1,24 @@
-import yaml
-import json
+import orjson
+import os
 import re
 from typing import List, Dict, Optional
 
 import ollama
 
 from utils import params
+from utils.aio import run_sync
 from utils.history import History
+from utils.prompts import load_prompts
+
+# Compiled once; fallback when the bracket scan finds nothing balanced
+# (e.g. a bracket inside a string literal throws the depth count off)
+_JSON_ARR_RE = re.compile(r"\[\s*{.*?}\s*\]", re.DOTALL)
 
 
 class PRE_NLU:
-    def __init__(self, model: str, prompt_path: str, eval_mode: bool = False):
+    def __init__(self, model: str, prompt_path: str, eval_mode: bool = False,
+                 client: ollama.AsyncClient | None = None,
+                 sync_client: ollama.Client | None = None):
         """
         Initializes the intent classifier (Pre-NLU step).
 
@@ -18,6 +26,8 @@ class PRE_NLU:
             model (str): Name of the LLM to query.
             prompt_path (str): Path to the YAML prompt file.
             eval_mode (bool): Whether evaluation mode is enabled.
+            client: Shared async ollama client; created when not given.
+            sync_client: Shared sync ollama client; created when not given.
         """
         self.model = model
         self.prompt_path = prompt_path
@@ -25,12 +35,50 @@ class PRE_NLU:
         self.history = History()
         self.history.history_limit = 6
 
+        # Persistent clients pinned to one host: requests reuse the same HTTP
+        # connection instead of paying a TCP handshake per call
+        host = os.environ.get("OLLAMA_HOST", "http://localhost:11434")
+        self.client = client or ollama.AsyncClient(host=host)
+        self.sync_client = sync_client or ollama.Client(host=host)
+
         self.valid_intents = params.VALID_INTENTS
         self.prompts = self._load_prompts()
 
+        # Guided decoding: the server only emits intent lists matching this
+        # schema, so malformed-JSON retries (each one a full LLM call) go away
+        self._format_schema = {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "intent": {"type": "string", "enum": list(params.VALID_INTENTS_ORDER)},
+                    "text": {"type": "string"}
+                },
+                "required": ["intent", "text"]
+            }
+        }
+
     def _load_prompts(self) -> Dict:
-        with open(self.prompt_path, "r") as f:
-            return yaml.safe_load(f)
+        return load_prompts(self.prompt_path)
+
+    def warmup_prefix(self) -> None:
+        """
+        Pre-fills the server-side KV cache for the static system prompt,
+        so later calls only pay for the user suffix.
+        """
+        try:
+            self.sync_client.chat(
+                model=self.model,
+                messages=[
+                    {"role": "system", "content": self.prompts["pre_nlu"]["prompt"]},
+                    {"role": "user", "content": "."}
+                ],
+                options={"num_predict": 1},
+                keep_alive=-1
+            )
+        except Exception:
+            # Best-effort: the server may not be reachable yet
+            pass
 
     def __call__(self, user_input: str = " ", system_response: str = " ") -> List[Dict]:
         """
@@ -43,31 +91,41 @@ class PRE_NLU:
         Returns:
             List[Dict]: Detected intents with cleaned structure.
         """
+        return run_sync(self.acall(user_input, system_response))
+
+    async def acall(self, user_input: str = " ", system_response: str = " ") -> List[Dict]:
+        """
+        Async variant of __call__, so independent callers (e.g. evaluation)
+        can keep several classification requests in flight at once.
+        """
         self.history.push("system", system_response)
         system_prompt = self.prompts["pre_nlu"]["prompt"]
 
-        while True:
-            raw_output = self._query_model(user_input, system_prompt)
+        raw_output = await self._aquery_model(user_input, system_prompt)
 
-            try:
-                cleaned_text = self._extract_json_array(raw_output)
-                intents = json.loads(cleaned_text)
+        try:
+            intents = orjson.loads(self._extract_json_array(raw_output))
 
-                if isinstance(intents, dict):
-                    intents = [intents]
+            if isinstance(intents, dict):
+                intents = [intents]
 
-                parsed = self._sanitize_intents(intents)
+            parsed = [
+                intent for intent in self._sanitize_intents(intents)
+                if intent.get("intent") in self.valid_intents
+            ]
+        except Exception as e:
+            print(f"[PRE-NLU] Invalid output: {raw_output}")
+            parsed = []
 
-                if all(intent.get("intent") in self.valid_intents for intent in parsed):
-                    break
-
-            except Exception as e:
-                print(f"[PRE-NLU] Invalid output: {raw_output}. Retrying...")
+        if not parsed:
+            # Guided decoding makes this near-impossible; degrade gracefully
+            # instead of burning another LLM round-trip
+            parsed = [{"intent": "out_of_context", "text": user_input}]
 
         self.history.push("user", user_input)
         return parsed
 
-    def _query_model(self, user_input: str, system_prompt: str) -> str:
+    async def _aquery_model(self, user_input: str, system_prompt: str) -> str:
         messages = [
             {"role": "system", "content": system_prompt}
         ]
@@ -88,24 +146,46 @@ class PRE_NLU:
             "content": user_input
         })
 
-        response = ollama.chat(
+        response = await self.client.chat(
             model=self.model,
             messages=messages,
-            options={"num_predict": 200}
+            format=self._format_schema,
+            # The reply echoes the user's text verbatim (one chunk per
+            # intent), so the ceiling scales with the input instead of
+            # assuming short JSON; 200 is a floor for the scaffolding
+            options={"num_predict": max(200, len(user_input))},
+            keep_alive=-1
         )
 
         return response["message"]["content"]
 
     def _extract_json_array(self, raw_text: str) -> str:
         """
-        Extracts a JSON array or object string from model output.
+        Extracts the first balanced JSON array of objects from model output
+        via a single-pass bracket scan.
         """
-        pattern = r"\[\s*{.*?}\s*\]"
-        match = re.search(pattern, raw_text, re.DOTALL)
-
-        if match:
-            return match.group(0)
-        return raw_text
+        start = raw_text.find("[")
+
+        while start != -1:
+            # Only accept arrays whose first element is an object
+            nxt = start + 1
+            while nxt < len(raw_text) and raw_text[nxt].isspace():
+                nxt += 1
+
+            if nxt < len(raw_text) and raw_text[nxt] == "{":
+                depth = 0
+                for i in range(start, len(raw_text)):
+                    if raw_text[i] == "[":
+                        depth += 1
+                    elif raw_text[i] == "]":
+                        depth -= 1
+                        if depth == 0:
+                            return raw_text[start:i + 1]
+
+            start = raw_text.find("[", start + 1)
+
+        match = _JSON_ARR_RE.search(raw_text)
+        return match.group(0) if match else raw_text
 
     def _sanitize_intents(self, intents: List[Dict]) -> List[Dict]:
         """
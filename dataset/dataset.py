@@ -1,20 +1,104 @@
+import atexit
 import pandas as pd
-import json
+import numpy as np
+import orjson
+import os
 import re
-from typing import Dict, Any, List, Optional
-from copy import deepcopy
+from functools import lru_cache
+from typing import Dict, Any, List, Optional, Tuple
 from rapidfuzz import process, fuzz
 
 
 class BeerDataset:
+    _COL_MAP = {
+        "Id": "id",
+        "Name": "name",
+        "Beer Full Name": "full_name",
+        "Style": "style",
+        "Brewery": "brewery",
+        "Description": "description",
+        "ABV": "abv",
+        "Min IBU": "min_ibu",
+        "Max IBU": "max_ibu",
+        "Rating": "rating"
+    }
+
     def __init__(self, path: str = "dataset/beer_data.csv"):
         """
         Loads and queries beer metadata from a CSV source.
         """
-        self.data = pd.read_csv(path)
+        self.data = self._load_frame(path)
         self.path = path
         self._limit = len(self.data)
 
+        # Ratings are appended to a JSONL log and folded back into the CSV
+        # on exit, instead of rewriting the whole file per rating
+        self._rating_log_path = path + ".ratings.jsonl"
+        self._ratings_dirty = False
+        self._replay_rating_log()
+        atexit.register(self._compact_ratings)
+
+        # Cast numeric columns once at load time so filters work on boolean
+        # masks over the original frame instead of per-request copies
+        for col in ["ABV", "Min IBU", "Max IBU", "Rating"]:
+            self.data[col] = pd.to_numeric(self.data[col], errors="coerce")
+
+        self._name_clean = (
+            self.data["Name"].astype(str).str.lower()
+            .str.replace(r"\(.*?\)", "", regex=True)
+            .str.replace(r"[^\w\s]", "", regex=True)
+            .str.replace(r"\s+", " ", regex=True)
+            .str.strip()
+        )
+        self._style_lower = self.data["Style"].str.lower()
+
+        # Unique choice lists for the fuzzy matchers, plus maps back to row
+        # positions, so each query scores every string only once
+        self._unique_names_clean = self._name_clean.dropna().unique().tolist()
+        self._unique_breweries = self.data["Brewery"].dropna().unique().tolist()
+        self._unique_styles = self.data["Style"].dropna().unique()
+
+        self._name_rows: Dict[str, List[int]] = {}
+        for row, value in enumerate(self._name_clean):
+            self._name_rows.setdefault(value, []).append(row)
+
+        self._brewery_rows: Dict[str, List[int]] = {}
+        for row, value in enumerate(self.data["Brewery"]):
+            self._brewery_rows.setdefault(value, []).append(row)
+
+        # Row counts per unique value, aligned with the choice arrays, so
+        # threshold picking can stay in NumPy
+        self._unique_names_arr = np.array(self._unique_names_clean, dtype=object)
+        self._unique_breweries_arr = np.array(self._unique_breweries, dtype=object)
+        self._name_counts = np.array([len(self._name_rows[v]) for v in self._unique_names_clean])
+        self._brewery_counts = np.array([len(self._brewery_rows[v]) for v in self._unique_breweries])
+
+    @staticmethod
+    def _load_frame(path: str) -> pd.DataFrame:
+        """
+        Loads the dataset, preferring a Parquet sidecar over the CSV.
+
+        Parquet stores the columnar layout and dtypes on disk, so startup
+        skips CSV tokenization entirely. The sidecar is rebuilt whenever the
+        CSV is newer and silently skipped when no Parquet engine (pyarrow or
+        fastparquet) is installed.
+        """
+        parquet_path = os.path.splitext(path)[0] + ".parquet"
+
+        try:
+            if (os.path.exists(parquet_path)
+                    and os.path.getmtime(parquet_path) >= os.path.getmtime(path)):
+                return pd.read_parquet(parquet_path)
+        except Exception:
+            pass
+
+        data = pd.read_csv(path)
+        try:
+            data.to_parquet(parquet_path, index=False)
+        except Exception:
+            pass
+        return data
+
     def filter_by_intent(self, slots: Dict[str, Any], intent: str, top_k: int = 5) -> Optional[str]:
         """
         Filters beer dataset based on extracted slots.
@@ -27,23 +111,26 @@ class BeerDataset:
         Returns:
             Optional[str]: JSON string with beer list, or None.
         """
-        df = deepcopy(self.data)
+        mask = pd.Series(True, index=self.data.index)
 
         for key, value in slots.items():
             if value is None or value == "null":
                 continue
             if key == "style":
-                df = self._filter_by_style(value, df)
+                mask &= self._style_mask(value)
             elif key == "abv":
-                df = self._filter_by_abv(value, df)
+                mask &= self._abv_mask(value)
             elif key == "ibu":
-                df = self._filter_by_ibu(value, df)
+                mask &= self._ibu_mask(value)
             elif key == "rating":
-                df = self._filter_by_rating(value, df)
+                mask &= self._rating_mask(value)
             elif key == "name":
-                df = self._filter_by_name(value, df)
+                mask &= self._name_mask(value)
             elif key == "brewery":
-                df = self._filter_by_brewery(value, df)
+                mask &= self._brewery_mask(value)
+
+        # Rows are only materialized here, after all masks are combined
+        df = self.data.loc[mask]
 
         if df.empty:
             return None
@@ -91,7 +178,15 @@ class BeerDataset:
         if comment:
             self.data.loc[indices, "User Comment"] = f'"{comment}"'
 
-        self.data.to_csv(self.path, index=False)
+        # O(1) append on the conversation path; the CSV is rewritten once,
+        # at compaction time
+        with open(self._rating_log_path, "ab") as log:
+            log.write(orjson.dumps({
+                "indices": [int(i) for i in indices],
+                "rating": rating,
+                "comment": comment
+            }) + b"\n")
+        self._ratings_dirty = True
 
         row = self.data.loc[indices[0]]
         return {
@@ -103,31 +198,56 @@ class BeerDataset:
             }
         }
 
-    def _format_json(self, df: pd.DataFrame) -> str:
-        beers = []
-        df_dict = df.to_dict()
-
-        for row_id in df_dict["Id"]:
-            beers.append({
-                "id": row_id,
-                "name": df_dict["Name"].get(row_id),
-                "full_name": df_dict["Beer Full Name"].get(row_id),
-                "style": df_dict["Style"].get(row_id),
-                "brewery": df_dict["Brewery"].get(row_id),
-                "description": df_dict["Description"].get(row_id),
-                "abv": df_dict["ABV"].get(row_id),
-                "min_ibu": df_dict["Min IBU"].get(row_id),
-                "max_ibu": df_dict["Max IBU"].get(row_id),
-                "rating": df_dict["Rating"].get(row_id)
-            })
-
-        return json.dumps({"beers": beers}, indent=4)
-
-    def _filter_by_abv(self, level: str, data: pd.DataFrame) -> pd.DataFrame:
-        df = data.copy()
-        df["ABV"] = pd.to_numeric(df["ABV"], errors="coerce")
-        df = df.dropna(subset=["ABV"])
+    def _replay_rating_log(self) -> None:
+        """
+        Re-applies ratings logged by a previous run that did not compact.
+        """
+        if not os.path.exists(self._rating_log_path):
+            return
+
+        with open(self._rating_log_path, "r") as log:
+            for line in log:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = orjson.loads(line)
+                except ValueError:
+                    continue
+
+                indices = entry.get("indices", [])
+                self.data.loc[indices, "User Rating"] = entry.get("rating")
+                comment = entry.get("comment")
+                if comment:
+                    self.data.loc[indices, "User Comment"] = f'"{comment}"'
+
+        self._ratings_dirty = True
+
+    def _compact_ratings(self) -> None:
+        """
+        Folds logged ratings back into the CSV and clears the log.
+        """
+        if not self._ratings_dirty:
+            return
+
+        self.data.to_csv(self.path, index=False)
+        try:
+            os.remove(self._rating_log_path)
+        except OSError:
+            pass
+        self._ratings_dirty = False
 
+    def _format_json(self, df: pd.DataFrame) -> str:
+        # Single C-level transpose instead of per-row dict reconstruction;
+        # compact separators keep the payload sent to the LLM small
+        beers = (
+            df[list(self._COL_MAP)]
+            .rename(columns=self._COL_MAP)
+            .to_dict(orient="records")
+        )
+        return orjson.dumps({"beers": beers}).decode()
+
+    def _abv_mask(self, level: str) -> pd.Series:
         bounds = {
             "low": (0.0, 4.9),
             "medium": (5.0, 7.9),
@@ -135,14 +255,10 @@ class BeerDataset:
         }
 
         low, high = bounds.get(level, (0, 100))
-        return df[(df["ABV"] >= low) & (df["ABV"] <= high)]
-
-    def _filter_by_ibu(self, level: str, data: pd.DataFrame) -> pd.DataFrame:
-        df = data.copy()
-        df["Min IBU"] = pd.to_numeric(df["Min IBU"], errors="coerce")
-        df["Max IBU"] = pd.to_numeric(df["Max IBU"], errors="coerce")
-        df = df.dropna(subset=["Min IBU", "Max IBU"])
+        abv = self.data["ABV"]
+        return (abv >= low) & (abv <= high)
 
+    def _ibu_mask(self, level: str) -> pd.Series:
         ranges = {
             "low": (0, 20),
             "medium": (21, 60),
@@ -150,85 +266,116 @@ class BeerDataset:
         }
 
         low, high = ranges.get(level, (0, 120))
-        return df[(df["Max IBU"] >= low) & (df["Min IBU"] <= high)]
+        return (self.data["Max IBU"] >= low) & (self.data["Min IBU"] <= high)
 
-    def _filter_by_rating(self, val: Any, data: pd.DataFrame) -> pd.DataFrame:
-        df = data.copy()
-        df["Rating"] = pd.to_numeric(df["Rating"], errors="coerce")
-        df = df.dropna(subset=["Rating"])
+    def _rating_mask(self, val: Any) -> pd.Series:
+        rating = self.data["Rating"]
 
         if isinstance(val, (list, tuple)) and len(val) == 2:
             low, high = float(val[0]), float(val[1])
-            return df[(df["Rating"] >= low) & (df["Rating"] <= high)]
+            return (rating >= low) & (rating <= high)
         try:
-            return df[df["Rating"] >= float(val)]
+            return rating >= float(val)
         except:
-            return df
+            return pd.Series(True, index=self.data.index)
 
-    def _filter_by_style(self, query: str, data: pd.DataFrame) -> pd.DataFrame:
+    def _style_mask(self, query: str) -> pd.Series:
         q = re.sub(r"\s+", " ", query.strip().lower())
         tokens = re.findall(r"\w+", q)
 
-        col = data["Style"].dropna().str.lower()
-
-        mask = col.notna()
+        substr_mask = self._style_lower.notna()
         for token in tokens:
-            mask &= col.str.contains(re.escape(token), na=False)
-
-        substr_styles = data["Style"][mask].unique().tolist()
-        df_substr = data[data["Style"].isin(substr_styles)] if substr_styles else pd.DataFrame()
-
-        unique_styles = data["Style"].dropna().unique()
-        fuzzy_styles = []
+            substr_mask &= self._style_lower.str.contains(re.escape(token), na=False)
+
+        fuzzy_styles = self._match_styles(q)
+        fuzzy_mask = (
+            self.data["Style"].isin(fuzzy_styles) if fuzzy_styles
+            else pd.Series(False, index=self.data.index)
+        )
+
+        # Intersect when both sides matched (O(n) on boolean masks, no merge),
+        # fall back to the union, then to whichever side is non-empty. The
+        # old code only merged when both frames were non-empty; whenever
+        # either side came up empty it fell through to an `or` over the
+        # frames, and DataFrame truthiness always raises ValueError — so
+        # those queries crashed instead of falling back.
+        if substr_mask.any() and fuzzy_mask.any():
+            both = substr_mask & fuzzy_mask
+            return both if both.any() else (substr_mask | fuzzy_mask)
+        return substr_mask if substr_mask.any() else fuzzy_mask
+
+    @lru_cache(maxsize=1024)
+    def _match_styles(self, query: str) -> Tuple[str, ...]:
+        # One cdist pass over the unique styles; the threshold schedule then
+        # runs on the cached score vector instead of rescanning per threshold
+        scores = process.cdist([query], self._unique_styles, scorer=fuzz.token_set_ratio,
+                               dtype=np.uint8, workers=-1)[0]
         for threshold in [90, 85, 80, 75]:
-            matches = process.extract(q, unique_styles, scorer=fuzz.token_set_ratio, score_cutoff=threshold)
-            if matches:
-                fuzzy_styles = [m[0] for m in matches]
-                break
-
-        df_fuzzy = data[data["Style"].isin(fuzzy_styles)] if fuzzy_styles else pd.DataFrame()
-
-        if not df_substr.empty and not df_fuzzy.empty:
-            intersect = pd.merge(df_substr, df_fuzzy, how="inner")
-            return intersect if not intersect.empty else pd.concat([df_substr, df_fuzzy]).drop_duplicates()
-        return df_substr or df_fuzzy or data.iloc[0:0]
-
-    def _filter_by_name(self, query: str, data: pd.DataFrame, threshold: float = 90.0) -> pd.DataFrame:
-        df = data.copy()
-        name = query.strip().lower()
+            mask = scores >= threshold
+            if mask.any():
+                return tuple(self._unique_styles[mask])
+        return ()
+
+    @lru_cache(maxsize=1024)
+    def _match_names(self, query: str, threshold: float = 90.0) -> Tuple[str, ...]:
+        scores = process.cdist([query], self._unique_names_clean, scorer=fuzz.ratio,
+                               dtype=np.uint8, workers=-1)[0]
+        return self._pick_matches(scores, self._name_counts, self._unique_names_arr, threshold)
+
+    @lru_cache(maxsize=1024)
+    def _match_breweries(self, query: str, threshold: float = 90.0) -> Tuple[str, ...]:
+        scores = process.cdist([query], self._unique_breweries, scorer=fuzz.ratio,
+                               dtype=np.uint8, workers=-1)[0]
+        return self._pick_matches(scores, self._brewery_counts, self._unique_breweries_arr, threshold)
+
+    @staticmethod
+    def _pick_matches(scores: np.ndarray, counts: np.ndarray, choices: np.ndarray,
+                      threshold: float) -> Tuple[str, ...]:
+        """
+        Walks the usual adaptive-threshold schedule over a precomputed score
+        vector. Scores are uint8 in 0..100, so a reverse-cumulative histogram
+        gives the row count at every possible threshold in one vectorized
+        pass; the walk itself is then O(1) table lookups, with no per-step
+        mask rebuild.
+        """
+        per_score = np.bincount(scores, weights=counts, minlength=101)
+        rows_at_least = np.cumsum(per_score[::-1])[::-1]
 
-        df["Name_clean"] = df["Name"].astype(str).str.lower()
-        df["Name_clean"] = df["Name_clean"].str.replace(r"\(.*?\)", "", regex=True)
-        df["Name_clean"] = df["Name_clean"].str.replace(r"[^\w\s]", "", regex=True)
-        df["Name_clean"] = df["Name_clean"].str.replace(r"\s+", " ", regex=True).str.strip()
+        threshold = int(threshold)
+        seen = {threshold}
 
         while True:
-            matches = process.extract(name, df["Name_clean"], scorer=fuzz.ratio, limit=self._limit, score_cutoff=threshold)
-            matched = [m[0] for m in matches]
-            result = df[df["Name_clean"].isin(matched)]
-
-            if result.empty and threshold > 30:
-                threshold -= 5
-            elif len(result) > 10 and threshold < 100:
-                threshold += 1
+            count = int(rows_at_least[threshold])
+
+            if count == 0 and threshold > 30:
+                nxt = threshold - 5
+            elif count > 10 and threshold < 100:
+                nxt = threshold + 1
             else:
                 break
 
-        return result
+            if nxt in seen:
+                # No threshold separates "none" from "too many": prefer the
+                # non-empty side instead of oscillating forever
+                if count == 0:
+                    threshold = nxt
+                break
 
-    def _filter_by_brewery(self, query: str, data: pd.DataFrame, threshold: float = 90.0) -> pd.DataFrame:
-        df = data.copy()
+            threshold = nxt
+            seen.add(threshold)
 
-        while True:
-            matches = process.extract(query, df["Brewery"], scorer=fuzz.ratio, limit=self._limit, score_cutoff=threshold)
-            matched = [m[0] for m in matches]
-            result = df[df["Brewery"].isin(matched)]
-
-            if result.empty and threshold > 30:
-                threshold -= 5
-            elif len(result) > 10 and threshold < 100:
-                threshold += 1
-            else:
-                break
+        return tuple(choices[scores >= threshold])
+
+    def _rows_to_mask(self, values: Tuple[str, ...], rows_by_value: Dict[str, List[int]]) -> pd.Series:
+        mask = np.zeros(len(self.data), dtype=bool)
+        for value in values:
+            mask[rows_by_value[value]] = True
+        return pd.Series(mask, index=self.data.index)
+
+    def _name_mask(self, query: str) -> pd.Series:
+        matched = self._match_names(query.strip().lower())
+        return self._rows_to_mask(matched, self._name_rows)
 
-        return result
\ No newline at end of file
+    def _brewery_mask(self, query: str) -> pd.Series:
+        matched = self._match_breweries(query)
+        return self._rows_to_mask(matched, self._brewery_rows)
@@ -1,8 +1,10 @@
+import asyncio
 import json
 import argparse
+import os
 from termcolor import colored
 from tqdm import tqdm
-from collections import defaultdict
+from collections import defaultdict, deque
 
 # --- make imports work no matter the cwd / debugger ---
 from pathlib import Path
@@ -17,11 +19,74 @@ from components.pre_nlu import PRE_NLU
 from components.nlu import NLU
 from components.dm import DM
 
+# orjson parses and serializes roughly an order of magnitude faster than
+# stdlib json; fall back transparently when it is not installed
+try:
+    import orjson
+
+    def _json_loads(data):
+        return orjson.loads(data)
+
+    def _json_dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+except ImportError:
+    def _json_loads(data):
+        return json.loads(data)
+
+    def _json_dumps(obj):
+        return json.dumps(obj, indent=4)
+
+# ijson parses incrementally, so huge datasets never hold raw text and a
+# full document tree in memory at once; optional like orjson above
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Below this size a single-pass parse is faster than streaming
+_STREAM_THRESHOLD_BYTES = 50 * 1024 * 1024
+
+
+def _load_dataset(path):
+    '''
+    Loads an evaluation dataset (a top-level JSON array of samples).
+    Files above the streaming threshold are parsed record-by-record with
+    ijson when it is installed; smaller files take the one-shot parse.
+    '''
+    if ijson is not None and os.path.getsize(path) > _STREAM_THRESHOLD_BYTES:
+        with open(path, "rb") as file:
+            return [sample for sample in ijson.items(file, "item")]
+
+    with open(path, "r") as file:
+        return _json_loads(file.read())
+
+
+def _ensure_list(value):
+    # Exact type check: eval data is plain lists, and type() is cheaper
+    # than isinstance in this per-sample path
+    return value if type(value) is list else [value]
+
+
+def _write_err(log, kind, **fields):
+    '''
+    Writes one formatted error block to the log. Field names use
+    underscores in place of spaces; non-string values are dumped as JSON.
+    '''
+    log.write(f"\n--- ERROR: {kind} ---\n")
+    for name, value in fields.items():
+        rendered = value if isinstance(value, str) else _json_dumps(value)
+        log.write(f"{name.replace('_', ' ')}: {rendered}\n")
+    log.write("\n------------------------------\n")
+
 class Evaluation:
     '''
     Class to perform intrinsic evaluation of the NLU and DM components.
     '''
 
+    # Number of samples evaluated concurrently; the LLM server is the
+    # bottleneck, so this should match its request-level parallelism
+    CONCURRENCY = 16
+
     def __init__(self, config):
         self.model = config['model']
         self.prompts_path = config['prompts_path']
@@ -39,8 +104,17 @@ class Evaluation:
         Method to evaluate the NLU component. Take example from dataset and compare the expected output with the predicted output.
         Calculate the intent accuracy, slot accuracy, and intent-wise performance (precision, recall, f1-score).
         '''
-        with open(self.dataset_path_nlu, "r") as file:
-            dataset = json.load(file)
+        dataset = _load_dataset(self.dataset_path_nlu)
+
+        # Expected slot strings are lower-cased once here, instead of
+        # allocating fresh lower-cased copies on every comparison
+        for example in dataset:
+            for expected in _ensure_list(example["output"]):
+                slots = expected.get("slots")
+                if slots:
+                    for name, value in slots.items():
+                        if isinstance(value, str):
+                            slots[name] = value.lower()
 
         total_intent_counts = defaultdict(int)
         correct_intent_counts = defaultdict(int)
@@ -49,85 +123,112 @@ class Evaluation:
         correct_slots = 0
         total_segments = 0
 
-        with open(self.error_log_path_nlu, "w") as error_log:
-
-            progress_bar = tqdm(dataset, desc="Evaluating NLU", unit="sample", 
-                                dynamic_ncols=True)
-            for example in progress_bar:
-                user_input = example["input"]
-                print(colored(f"===== USER INPUT =====\n{user_input}", "green"))
-                expected_outputs = example["output"]
-
-                # Get model predictions
-                output_pre_nlu = self.pre_nlu(user_input, system_response=" ")
-                predicted_outputs = self.nlu(output_pre_nlu, user_input, system=" ")
-
-                # Ensure both expected and predicted outputs are lists
-                if not isinstance(expected_outputs, list):
-                    expected_outputs = [expected_outputs]
-                if not isinstance(predicted_outputs, list):
-                    predicted_outputs = [predicted_outputs]
-
-                total_segments += len(expected_outputs)
-
-                for expected in expected_outputs:
-                    total_intent_counts[expected["intent"]] += 1
-
-                    # Find the predicted output that matches the expected output
-                    predicted = next((output for output in predicted_outputs if output["intent"] == expected["intent"]), None)
-                    if predicted is None:
-                        error_log.write("\n--- ERROR: MISSING PREDICTION ---\n")
-                        error_log.write(f"Input: {user_input}\n")
-                        error_log.write(f"Expected Intent: {expected['intent']}\n")
-                        error_log.write(f"Expected Slots: {json.dumps(expected.get('slots', {}), indent=4)}\n")
-                        error_log.write("\n------------------------------\n")
-                        error_log.flush()  
-                        continue
+        # Running scalar totals, kept in step with the per-intent dicts so the
+        # progress bar does not re-sum both dicts on every sample
+        running_total_intents = 0
+        running_correct_intents = 0
+
+        with open(self.error_log_path_nlu, "w", buffering=1 << 20) as error_log:
+
+            async def predict(example):
+                # The semaphore bounds how many samples are in flight; each
+                # sample still runs pre-NLU before NLU sequentially
+                async with semaphore:
+                    user_input = example["input"]
+                    print(colored(f"===== USER INPUT =====\n{user_input}", "green"))
+                    output_pre_nlu = await self.pre_nlu.acall(user_input, system_response=" ")
+                    predicted_outputs = await self.nlu.acall(output_pre_nlu, user_input, system_utterance=" ")
+                    return example, predicted_outputs
+
+            async def run_eval():
+                nonlocal total_slots, correct_slots, total_segments
+                nonlocal running_total_intents, running_correct_intents
+
+                progress_bar = tqdm(total=len(dataset), desc="Evaluating NLU", unit="sample",
+                                    dynamic_ncols=True)
+                tasks = [predict(example) for example in dataset]
+
+                # Scoring (and error logging) happens only here, on the main
+                # coroutine, so counters and the log need no locking
+                for future in asyncio.as_completed(tasks):
+                    example, predicted_outputs = await future
+                    user_input = example["input"]
+                    expected_outputs = example["output"]
+
+                    # Ensure both expected and predicted outputs are lists
+                    expected_outputs = _ensure_list(expected_outputs)
+                    predicted_outputs = _ensure_list(predicted_outputs)
+
+                    total_segments += len(expected_outputs)
+
+                    # One dict built per sample instead of a linear scan of
+                    # the predictions for every expected segment
+                    pred_by_intent = {output["intent"]: output for output in predicted_outputs}
+
+                    for expected in expected_outputs:
+                        total_intent_counts[expected["intent"]] += 1
+                        running_total_intents += 1
+
+                        # Find the predicted output that matches the expected output
+                        predicted = pred_by_intent.get(expected["intent"])
+                        if predicted is None:
+                            _write_err(error_log, "MISSING PREDICTION",
+                                       Input=user_input,
+                                       Expected_Intent=expected["intent"],
+                                       Expected_Slots=expected.get("slots", {}))
+                            continue
                     
-                    predicted_intent_counts[predicted["intent"]] += 1
-
-                    if expected["intent"] == predicted["intent"]:
-                        correct_intent_counts[expected["intent"]] += 1
-                    else:
-                        error_log.write("\n--- ERROR: INTENT MISMATCH ---\n")
-                        error_log.write(f"Input: {user_input}\n")
-                        error_log.write(f"Expected Intent: {expected['intent']}\n")
-                        error_log.write(f"Expected Slots: {json.dumps(expected.get('slots', {}), indent=4)}\n")
-                        error_log.write(f"Predicted Intent: {predicted['intent']}\n")
-                        error_log.write(f"Predicted Slots: {json.dumps(predicted.get('slots', {}), indent=4)}\n")
-                        error_log.write("\n------------------------------\n")
-                        error_log.flush()  
-
-                    # Compare slot predictions
-                    expected_slots = expected.get("slots", {})
-                    predicted_slots = predicted.get("slots", {})
-
-                    for slot_name, expected_value in expected_slots.items():
-                        total_slots += 1  
-                        predicted_value = predicted_slots.get(slot_name)
-
-                        if isinstance(expected_value, str) and isinstance(predicted_value, str):
-                            expected_value = expected_value.lower()
-                            predicted_value = predicted_value.lower()
-
-                        if predicted_value == expected_value:
-                            correct_slots += 1
+                        predicted_intent_counts[predicted["intent"]] += 1
+
+                        if expected["intent"] == predicted["intent"]:
+                            correct_intent_counts[expected["intent"]] += 1
+                            running_correct_intents += 1
                         else:
-                            error_log.write("\n--- ERROR: SLOT MISMATCH ---\n")
-                            error_log.write(f"Input: {user_input}\n")
-                            error_log.write(f"Expected Intent: {expected['intent']}\n")
-                            error_log.write(f"Expected Slots: {json.dumps(expected.get('slots', {}), indent=4)}\n")
-                            error_log.write(f"Predicted Intent: {predicted['intent']}\n")
-                            error_log.write(f"Predicted Slots: {json.dumps(predicted.get('slots', {}), indent=4)}\n")
-                            error_log.write("\n------------------------------\n")
-                            error_log.flush()
+                            _write_err(error_log, "INTENT MISMATCH",
+                                       Input=user_input,
+                                       Expected_Intent=expected["intent"],
+                                       Expected_Slots=expected.get("slots", {}),
+                                       Predicted_Intent=predicted["intent"],
+                                       Predicted_Slots=predicted.get("slots", {}))
+
+                        # Compare slot predictions; predicted values are
+                        # normalized once per prediction, not per slot
+                        expected_slots = expected.get("slots", {})
+                        predicted_slots = {
+                            name: (value.lower() if isinstance(value, str) else value)
+                            for name, value in predicted.get("slots", {}).items()
+                        }
+
+                        for slot_name, expected_value in expected_slots.items():
+                            total_slots += 1
+                            predicted_value = predicted_slots.get(slot_name)
+
+                            if predicted_value == expected_value:
+                                correct_slots += 1
+                            else:
+                                _write_err(error_log, "SLOT MISMATCH",
+                                           Input=user_input,
+                                           Expected_Intent=expected["intent"],
+                                           Expected_Slots=expected.get("slots", {}),
+                                           Predicted_Intent=predicted["intent"],
+                                           Predicted_Slots=predicted.get("slots", {}))
           
 
-                # Update progress bar with accuracy
-                overall_intent_accuracy = sum(correct_intent_counts.values()) / sum(total_intent_counts.values()) * 100 if sum(total_intent_counts.values()) else 0
-                slot_accuracy = (correct_slots / total_slots) * 100 if total_slots else 0
+                    # Update progress bar with accuracy
+                    overall_intent_accuracy = running_correct_intents / running_total_intents * 100 if running_total_intents else 0
+                    slot_accuracy = (correct_slots / total_slots) * 100 if total_slots else 0
+
+                    progress_bar.update(1)
+                    # Crash safety for long runs: one flush per 100
+                    # samples instead of one per logged error
+                    if progress_bar.n % 100 == 0:
+                        error_log.flush()
+                    progress_bar.set_postfix({"Intent Acc": f"{overall_intent_accuracy:.2f}%", "Slot Acc": f"{slot_accuracy:.2f}%"})
+
+                progress_bar.close()
 
-                progress_bar.set_postfix({"Intent Acc": f"{overall_intent_accuracy:.2f}%", "Slot Acc": f"{slot_accuracy:.2f}%"})
+            semaphore = asyncio.Semaphore(self.CONCURRENCY)
+            asyncio.run(run_eval())
 
         # Compute final metrics per intent
         intent_metrics = {}
@@ -148,7 +249,7 @@ class Evaluation:
             
         # Print final results
         print("\nNLU Evaluation Results:")
-        overall_intent_accuracy = sum(correct_intent_counts.values()) / sum(total_intent_counts.values()) * 100 if sum(total_intent_counts.values()) else 0
+        overall_intent_accuracy = running_correct_intents / running_total_intents * 100 if running_total_intents else 0
         slot_accuracy = (correct_slots / total_slots) * 100 if total_slots else 0
         print(f"Overall Intent Accuracy: {overall_intent_accuracy:.2f}%")
         print(f"Overall Slot Accuracy: {slot_accuracy:.2f}%")
@@ -166,8 +267,7 @@ class Evaluation:
         Method to evaluate the DM component. Take example from dataset and compare the expected output with the predicted output.
         Calculate the action accuracy, parameter accuracy, and action-wise performance (precision, recall, f1-score).
         '''
-        with open(self.dataset_path_dm, "r") as file:
-            dataset = json.load(file)
+        dataset = _load_dataset(self.dataset_path_dm)
 
         total_actions = 0
         correct_actions = 0
@@ -177,99 +277,126 @@ class Evaluation:
         correct_predictions = defaultdict(int)
         total_expected_actions = defaultdict(int)
 
-        with open(self.error_log_path_dm, "w") as error_log:
-
-            progress_bar = tqdm(dataset, desc="Evaluating DM", unit="sample", dynamic_ncols=True)
-            for sample in progress_bar:
-                nlu_input = sample["input"]
-
-                expected_output = sample["output"]
-                expected_output = expected_output if isinstance(expected_output, list) else [expected_output]
-
-                dm_prediction = self.dm(nlu_input)
-                dm_prediction = dm_prediction if isinstance(dm_prediction, list) else [dm_prediction]
-
-                pairs = []
-                used = set()
-                for exp in expected_output:
-                    found = None
-                    for i, pred in enumerate(dm_prediction):
-                        if i in used:
+        # Per-action precision/recall terms are kept as running sums: each
+        # counter mutation replaces only its own action's term, so the
+        # progress bar no longer re-evaluates a genexp over all actions
+        precision_sum = 0.0
+        recall_sum = 0.0
+
+        def _prec_term(action):
+            denom = predicted_actions.get(action, 0)
+            return correct_predictions.get(action, 0) / denom if denom else 0
+
+        def _rec_term(action):
+            denom = total_expected_actions.get(action, 0)
+            return correct_predictions.get(action, 0) / denom if denom else 0
+
+        with open(self.error_log_path_dm, "w", buffering=1 << 20) as error_log:
+
+            async def predict(sample):
+                # Each sample is an independent conversation, so the DM gets
+                # fresh state containers instead of the shared stack
+                async with semaphore:
+                    prediction = await self.dm.acall(sample["input"], state_stack=[], state_by_intent={})
+                    return sample, prediction
+
+            async def run_eval():
+                nonlocal total_actions, correct_actions, correct_parameters, total_parameters
+                nonlocal precision_sum, recall_sum
+
+                progress_bar = tqdm(total=len(dataset), desc="Evaluating DM", unit="sample", dynamic_ncols=True)
+                tasks = [predict(sample) for sample in dataset]
+
+                # Scoring (and error logging) happens only here, on the main
+                # coroutine, so counters and the log need no locking
+                for future in asyncio.as_completed(tasks):
+                    sample, dm_prediction = await future
+                    nlu_input = sample["input"]
+
+                    expected_output = _ensure_list(sample["output"])
+                    dm_prediction = _ensure_list(dm_prediction)
+
+                    # Queue predictions per action, then pair each expected
+                    # action with the earliest unused prediction — same 1:1
+                    # semantics as the old nested scan, in a single pass
+                    pred_by_action = defaultdict(deque)
+                    for pred in dm_prediction:
+                        pred_by_action[pred["action"]].append(pred)
+
+                    pairs = []
+                    for exp in expected_output:
+                        queue = pred_by_action[exp["action"]]
+                        pairs.append((exp, queue.popleft() if queue else None))
+
+                    for exp, pred in pairs:
+                        total_actions += 1
+                        exp_action = exp["action"]
+                        exp_param = exp.get("parameter")
+                        recall_sum -= _rec_term(exp_action)
+                        total_expected_actions[exp_action] += 1
+                        recall_sum += _rec_term(exp_action)
+
+                        if pred is None:
+                            _write_err(error_log, "MISSING PREDICTION",
+                                       Input=nlu_input, Expected=exp, Predicted="None")
                             continue
-                        if pred["action"] == exp["action"]:
-                            found = i
-                            break
-                    if found is not None:
-                        pairs.append((exp, dm_prediction[found]))
-                        used.add(found)
-                    else:
-                        pairs.append((exp, None))
-
-                for exp, pred in pairs:
-                    total_actions += 1
-                    exp_action = exp["action"]
-                    exp_param = exp.get("parameter")
-                    total_expected_actions[exp_action] += 1
-
-                    if pred is None:
-                        error_log.write("\n--- ERROR: MISSING PREDICTION ---\n")
-                        error_log.write(f"Input: {json.dumps(nlu_input, indent=4)}\n")
-                        error_log.write(f"Expected: {json.dumps(exp, indent=4)}\n")
-                        error_log.write("Predicted: None\n")
-                        error_log.write("\n------------------------------\n")
-                        error_log.flush()
-                        continue
-
-                    pred_action = pred["action"]
-                    pred_param = pred.get("parameter")
-                    predicted_actions[pred_action] += 1
-
-                    if exp_action == pred_action:
-                        correct_actions += 1
-                        correct_predictions[exp_action] += 1
-                    else:
-                        error_log.write("\n--- ERROR: DM MISMATCH ---\n")
-                        error_log.write(f"Input: {json.dumps(nlu_input, indent=4)}\n")
-                        error_log.write(f"Expected: {json.dumps(exp, indent=4)}\n")
-                        error_log.write(f"Predicted: {json.dumps(pred, indent=4)}\n")
-                        error_log.write("\n------------------------------\n")
-                        error_log.flush()
 
-                    total_parameters += 1
-                    if isinstance(exp_param, list):
-                        if pred_param in exp_param:
-                            correct_parameters += 1
+                        pred_action = pred["action"]
+                        pred_param = pred.get("parameter")
+                        precision_sum -= _prec_term(pred_action)
+                        predicted_actions[pred_action] += 1
+                        precision_sum += _prec_term(pred_action)
+
+                        if exp_action == pred_action:
+                            correct_actions += 1
+                            precision_sum -= _prec_term(exp_action)
+                            recall_sum -= _rec_term(exp_action)
+                            correct_predictions[exp_action] += 1
+                            precision_sum += _prec_term(exp_action)
+                            recall_sum += _rec_term(exp_action)
                         else:
-                            error_log.write("\n--- ERROR: PARAMETER MISMATCH ---\n")
-                            error_log.write(f"Expected: {json.dumps(exp, indent=4)}\n")
-                            error_log.write(f"Predicted: {json.dumps(pred, indent=4)}\n")
-                            error_log.write("\n------------------------------\n")
-                            error_log.flush()
-                    else:
-                        if pred_param == exp_param:
+                            _write_err(error_log, "DM MISMATCH",
+                                       Input=nlu_input, Expected=exp, Predicted=pred)
+
+                        total_parameters += 1
+                        param_ok = (pred_param in exp_param if isinstance(exp_param, list)
+                                    else pred_param == exp_param)
+                        if param_ok:
                             correct_parameters += 1
                         else:
-                            error_log.write("\n--- ERROR: PARAMETER MISMATCH ---\n")
-                            error_log.write(f"Expected: {json.dumps(exp, indent=4)}\n")
-                            error_log.write(f"Predicted: {json.dumps(pred, indent=4)}\n")
-                            error_log.write("\n------------------------------\n")
-                            error_log.flush()
-
-                # Metrics
-                precision = sum(correct_predictions[a] / predicted_actions[a] if predicted_actions[a] else 0 for a in predicted_actions) / len(predicted_actions) if predicted_actions else 0
-                recall = sum(correct_predictions[a] / total_expected_actions[a] if total_expected_actions[a] else 0 for a in total_expected_actions) / len(total_expected_actions) if total_expected_actions else 0
-                f1 = (2 * precision * recall) / (precision + recall) if (precision + recall) > 0 else 0
-                action_accuracy = (correct_actions / total_actions) * 100 if total_actions else 0
-                parameter_accuracy = (correct_parameters / total_parameters) * 100 if total_parameters else 0
-
-                progress_bar.set_postfix({
-                    "Action Acc": f"{action_accuracy:.2f}%",
-                    "Param Acc": f"{parameter_accuracy:.2f}%",
-                    "Precision": f"{precision:.2f}",
-                    "Recall": f"{recall:.2f}",
-                    "F1-score": f"{f1:.2f}"
-                })
-
+                            _write_err(error_log, "PARAMETER MISMATCH",
+                                       Expected=exp, Predicted=pred)
+
+                    # Metrics
+                    precision = precision_sum / len(predicted_actions) if predicted_actions else 0
+                    recall = recall_sum / len(total_expected_actions) if total_expected_actions else 0
+                    f1 = (2 * precision * recall) / (precision + recall) if (precision + recall) > 0 else 0
+                    action_accuracy = (correct_actions / total_actions) * 100 if total_actions else 0
+                    parameter_accuracy = (correct_parameters / total_parameters) * 100 if total_parameters else 0
+
+                    progress_bar.update(1)
+                    # Crash safety for long runs: one flush per 100
+                    # samples instead of one per logged error
+                    if progress_bar.n % 100 == 0:
+                        error_log.flush()
+                    progress_bar.set_postfix({
+                        "Action Acc": f"{action_accuracy:.2f}%",
+                        "Param Acc": f"{parameter_accuracy:.2f}%",
+                        "Precision": f"{precision:.2f}",
+                        "Recall": f"{recall:.2f}",
+                        "F1-score": f"{f1:.2f}"
+                    })
+
+                progress_bar.close()
+
+            semaphore = asyncio.Semaphore(self.CONCURRENCY)
+            asyncio.run(run_eval())
+
+        # Metrics
+        precision = precision_sum / len(predicted_actions) if predicted_actions else 0
+        recall = recall_sum / len(total_expected_actions) if total_expected_actions else 0
+        f1 = (2 * precision * recall) / (precision + recall) if (precision + recall) > 0 else 0
+        action_accuracy = (correct_actions / total_actions) * 100 if total_actions else 0
 
         print(f1)
         print(precision)
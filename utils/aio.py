@@ -0,0 +1,32 @@
+import asyncio
+import threading
+from typing import Any, Coroutine
+
+# The shared loop lives on a daemon thread for the whole process. Async
+# ollama clients keep pooled keep-alive connections bound to the loop they
+# were last used on, so every coroutine that touches one must run here: a
+# fresh asyncio.run per call would close its loop and leave the pool
+# holding connections bound to a dead one, and the next call would raise
+# "RuntimeError: Event loop is closed".
+_loop: asyncio.AbstractEventLoop | None = None
+_loop_lock = threading.Lock()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """
+    Returns the shared event loop, starting it on first use.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever,
+                             name="ollama-loop", daemon=True).start()
+    return _loop
+
+
+def run_sync(coro: Coroutine[Any, Any, Any]) -> Any:
+    """
+    Runs a coroutine on the shared loop and blocks until it finishes.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
@@ -1,9 +1,22 @@
+import asyncio
+import copy
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+import ollama
+from rapidfuzz import fuzz, process
 from termcolor import colored
 
 from components import pre_nlu, nlu, dm, nlg
+from utils.aio import run_sync
 
 
 class DialogueOrchestrator:
+    # Minimum token_sort_ratio for a cached response to be reused on a
+    # near-identical repeat of the same turn
+    CACHE_SIMILARITY = 93
+
     def __init__(self, config: dict):
         """
         Initializes the dialogue system components.
@@ -13,10 +26,46 @@ class DialogueOrchestrator:
         self.eval_mode = True
         self.chat_active = True
 
-        self.pre_nlu = pre_nlu.PRE_NLU(self.model, self.prompts_path, self.eval_mode)
-        self.nlu = nlu.NLU(self.model, self.prompts_path, self.eval_mode)
-        self.dm = dm.DM(self.model, self.prompts_path, self.eval_mode)
-        self.nlg = nlg.NLG(self.model, self.prompts_path)
+        # One client pair for the whole dialogue system: all components share
+        # the same pooled HTTP connections instead of opening one pool each
+        host = os.environ.get("OLLAMA_HOST", "http://localhost:11434")
+        self._async_client = ollama.AsyncClient(host=host)
+        self._sync_client = ollama.Client(host=host)
+
+        self.pre_nlu = pre_nlu.PRE_NLU(self.model, self.prompts_path, self.eval_mode,
+                                       client=self._async_client, sync_client=self._sync_client)
+        self.nlu = nlu.NLU(self.model, self.prompts_path, self.eval_mode,
+                           client=self._async_client, sync_client=self._sync_client)
+        self.dm = dm.DM(self.model, self.prompts_path, self.eval_mode,
+                        client=self._async_client, sync_client=self._sync_client)
+        self.nlg = nlg.NLG(self.model, self.prompts_path, client=self._sync_client)
+
+        # Prefill the server-side KV cache for every static prompt prefix
+        # before the first turn, so user turns only pay for their suffix
+        for component in (self.pre_nlu, self.nlu, self.dm, self.nlg):
+            component.warmup_prefix()
+
+        # Response cache keyed on (user input, last system message, DM state
+        # fingerprint): exact repeats hit a dict; near-repeats fall through
+        # to a fuzzy scan over cached inputs seen in the same situation. A
+        # hit skips all four LLM calls for the turn and replays the turn's
+        # end state and history pushes, so later turns behave as if the
+        # pipeline had run. Each value is (response, end-of-turn DM state).
+        self._exact_cache: Dict[Tuple[str, str, Tuple[str, ...]], Tuple[str, tuple]] = {}
+        self._fuzzy_cache: Dict[Tuple[str, Tuple[str, ...]], List[Tuple[str, Tuple[str, tuple]]]] = {}
+
+        # Speculative DM execution: when a past turn taught us which intent a
+        # given input maps to, the DM decision for that intent is scheduled
+        # as a task on the same loop while the real NLU call is in flight,
+        # and is kept only if NLU agrees. The speculative DM shares the
+        # orchestrator's clients but works on copied state, committed back
+        # only on a hit.
+        # eval_mode stays off here even though the main DM runs with it on:
+        # validity checking forces request_info while slots are unfilled, so
+        # a guess can never take the confirmation path and record a rating
+        self._spec_dm = dm.DM(self.model, self.prompts_path, eval_mode=False,
+                              client=self._async_client, sync_client=self._sync_client)
+        self._intent_prior: Dict[str, str] = {}
 
         self.bot_name = colored("BeerBot", "red")
         self.user_name = colored("User", "green")
@@ -36,20 +85,167 @@ class DialogueOrchestrator:
             if not user_input:
                 continue
 
-            pre_nlu_output = self.pre_nlu(user_input, system_message)
+            nlg_output = run_sync(self._run_pipeline(user_input, system_message))
 
-            if any(intent.get("intent") == "terminate_system" for intent in pre_nlu_output):
+            if nlg_output is None:
                 print(f"{self.bot_name}: Goodbye! 🍻")
                 self.chat_active = False
                 return
 
-            nlu_output = self.nlu(pre_nlu_output, user_input, system_message)
-            dm_output = self.dm(nlu_output)
-            nlg_output = self.nlg(dm_output)
-
             system_message = nlg_output
             print(f"\n{self.bot_name}: {system_message}")
 
+    async def _run_pipeline(self, user_input: str, system_message: str) -> Optional[str]:
+        """
+        Runs one dialogue turn through PRE_NLU → NLU → DM → NLG. The whole
+        turn is one coroutine on the shared loop, so the pooled async client
+        connections are never carried across loops.
+
+        Returns:
+            Optional[str]: System response, or None when the user asked to
+            terminate the system.
+        """
+        state_key = self._state_fingerprint()
+        cached = self._cache_lookup(user_input, system_message, state_key)
+        if cached is not None:
+            return cached
+
+        pre_nlu_output = await self.pre_nlu.acall(user_input, system_message)
+
+        if any(intent.get("intent") == "terminate_system" for intent in pre_nlu_output):
+            return None
+
+        norm = self._normalize(user_input)
+
+        # Overlap the DM round-trip with the NLU one when a prior predicts
+        # the intent for this input; the guess is validated against the real
+        # NLU output before it is used
+        dm_task = spec_state = None
+        spec_intent = self._intent_prior.get(norm)
+        if spec_intent is not None and self._can_speculate(spec_intent):
+            spec_state = copy.deepcopy((self.dm.state_stack, self.dm._state_by_intent))
+            dm_task = asyncio.create_task(
+                self._spec_dm.acall([{"intent": spec_intent, "slots": {}}],
+                                    state_stack=spec_state[0],
+                                    state_by_intent=spec_state[1])
+            )
+
+        nlu_output = await self.nlu.acall(pre_nlu_output, user_input, system_message)
+
+        dm_output = None
+        if dm_task is not None:
+            if self._speculation_hit(nlu_output, spec_intent):
+                try:
+                    speculated = await dm_task
+                except Exception:
+                    # A failed guess is never worth the turn: fall back to
+                    # the normal DM call below
+                    speculated = None
+                # Only pure request_info decisions are committed from a
+                # guess; anything else is side-effect territory
+                if speculated is not None and all(
+                    isinstance(d, dict) and d.get("action") == "request_info"
+                    for d in speculated
+                ):
+                    dm_output = speculated
+                    self.dm.state_stack, self.dm._state_by_intent = spec_state
+            else:
+                # Wrong guess: cancel the in-flight call and discard its
+                # state copies, so the speculation leaves no trace
+                dm_task.cancel()
+
+        if dm_output is None:
+            dm_output = await self.dm.acall(nlu_output)
+
+        if len(nlu_output) == 1 and nlu_output[0].get("intent"):
+            self._intent_prior[norm] = nlu_output[0]["intent"]
+
+        nlg_output = self.nlg(dm_output)
+
+        self._cache_store(user_input, system_message, state_key, dm_output, nlg_output)
+        return nlg_output
+
+    @staticmethod
+    def _normalize(text: str) -> str:
+        return re.sub(r"\s+", " ", text.strip().lower())
+
+    def _can_speculate(self, intent: str) -> bool:
+        # A fully slot-filled state would take the confirmation path, which
+        # can touch the dataset (e.g. record a rating) — never run that on a
+        # guess
+        state = self.dm._state_by_intent.get(intent)
+        return state is None or any(v is None for v in state.slots.values())
+
+    @staticmethod
+    def _speculation_hit(nlu_output: List[Dict], spec_intent: str) -> bool:
+        # The speculative DM saw empty slots, so its decision only stands if
+        # NLU found the same single intent and no slot values either
+        if len(nlu_output) != 1 or nlu_output[0].get("intent") != spec_intent:
+            return False
+        slots = nlu_output[0].get("slots")
+        if not isinstance(slots, dict):
+            return not slots
+        return all(value in (None, "null") for value in slots.values())
+
+    def _state_fingerprint(self) -> Tuple[str, ...]:
+        # The serialized state stack pins a cached turn to the exact dialogue
+        # situation it was produced in, so two flows that reach the same
+        # system utterance with different slot states never collide
+        return tuple(state.serialize() for state in self.dm.state_stack)
+
+    def _cache_lookup(self, user_input: str, system_message: str,
+                      state_key: Tuple[str, ...]) -> Optional[str]:
+        norm = self._normalize(user_input)
+
+        hit = self._exact_cache.get((norm, system_message, state_key))
+        if hit is not None:
+            return self._replay_cached(user_input, system_message, hit)
+
+        entries = self._fuzzy_cache.get((system_message, state_key))
+        if not entries:
+            return None
+
+        best = process.extractOne(
+            norm, [entry[0] for entry in entries],
+            scorer=fuzz.token_sort_ratio, score_cutoff=self.CACHE_SIMILARITY
+        )
+        if best is None:
+            return None
+        return self._replay_cached(user_input, system_message, entries[best[2]][1])
+
+    def _replay_cached(self, user_input: str, system_message: str,
+                       entry: Tuple[str, tuple]) -> str:
+        """
+        Applies a cached turn as if the pipeline had produced it: restores
+        the DM state the turn ended with and advances the component
+        histories the way the skipped calls would have.
+        """
+        response, end_state = entry
+        self.dm.state_stack, self.dm._state_by_intent = copy.deepcopy(end_state)
+        for history in (self.pre_nlu.history, self.nlu.history):
+            history.push("system", system_message)
+            history.push("user", user_input)
+        return response
+
+    def _cache_store(self, user_input: str, system_message: str,
+                     state_key: Tuple[str, ...], dm_output: List[Dict],
+                     response: str) -> None:
+        if response == "error":
+            return
+
+        # Turns that recorded a rating must always re-run: replaying them
+        # from the cache would silently drop the new rating write
+        if any(isinstance(decision, dict) and decision.get("action") == "confirmation"
+               and decision.get("parameter") == "rate_beer" for decision in dm_output):
+            return
+
+        norm = self._normalize(user_input)
+        end_state = copy.deepcopy((self.dm.state_stack, self.dm._state_by_intent))
+        self._exact_cache[(norm, system_message, state_key)] = (response, end_state)
+        self._fuzzy_cache.setdefault((system_message, state_key), []).append(
+            (norm, (response, end_state))
+        )
+
     def display_intro(self):
         """
         Displays the welcome message and ASCII banner.
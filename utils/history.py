@@ -1,4 +1,5 @@
-from typing import List, Dict
+from collections import deque
+from typing import Deque, List, Dict
 
 
 class History:
@@ -9,12 +10,20 @@ class History:
         Args:
             limit (int): Maximum number of exchanges to store.
         """
-        self._memory: List[Dict[str, str]] = []
+        # deque(maxlen=...) evicts the oldest turn in O(1) instead of the
+        # O(n) element shift a list pop(0) costs
+        self._memory: Deque[Dict[str, str]] = deque(maxlen=limit)
         self.max_turns = limit
 
+        # Bumped on every mutation; lets get_history_str reuse its last
+        # result when the memory has not changed in between
+        self._version = 0
+        self._str_cache: tuple | None = None
+
     def reset(self) -> None:
         """Clears the entire memory buffer."""
         self._memory.clear()
+        self._version += 1
 
     def push(self, role: str, content: str) -> None:
         """
@@ -24,14 +33,12 @@ class History:
             role (str): Either 'user' or 'system'.
             content (str): Text content of the message.
         """
-        if len(self._memory) >= self.max_turns:
-            self._memory.pop(0)
-
         self._memory.append({"role": role, "content": content})
+        self._version += 1
 
     def get_history(self) -> List[Dict[str, str]]:
         """Returns the full dialogue history."""
-        return self._memory
+        return list(self._memory)
 
     def get_history_str(self) -> str:
         """
@@ -40,7 +47,13 @@ class History:
         Returns:
             str: Formatted conversation.
         """
-        return "\n".join(f"{entry['role']}: {entry['content']}" for entry in self._memory)
+        # Several components read the history each turn; rebuild the string
+        # only when the memory actually changed. The list comprehension lets
+        # str.join skip its slower generator path.
+        if self._str_cache is None or self._str_cache[0] != self._version:
+            text = "\n".join([f"{entry['role']}: {entry['content']}" for entry in self._memory])
+            self._str_cache = (self._version, text)
+        return self._str_cache[1]
 
     def clean(self, user_text: str) -> None:
         """
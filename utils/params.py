@@ -1,19 +1,24 @@
-# Intents for the beer recommendation system
-VALID_INTENTS = [
-    "get_beer_recommendation", 
-    "get_beer_info", 
+# Intents for the beer recommendation system.
+# Stable order, used wherever intents are enumerated (prompt schemas);
+# membership checks go through the frozensets below.
+VALID_INTENTS_ORDER = (
+    "get_beer_recommendation",
+    "get_beer_info",
     "list_beers_by_brewery",
     "get_top_rated",
     "rate_beer",
-    "out_of_context", 
+    "out_of_context",
     "terminate_system"
-]
+)
 
-VALID_SLOTS = [
-    "style", 
-    "abv", 
-    "ibu", 
-    "rating", 
-    "brewery", 
+# Frozensets give O(1) membership tests on the per-sample validation path
+VALID_INTENTS = frozenset(VALID_INTENTS_ORDER)
+
+VALID_SLOTS = frozenset({
+    "style",
+    "abv",
+    "ibu",
+    "rating",
+    "brewery",
     "name"
-]
\ No newline at end of file
+})
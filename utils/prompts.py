@@ -0,0 +1,31 @@
+import os
+from functools import lru_cache
+from typing import Dict
+
+import yaml
+
+# PyYAML's pure-Python scanner is slow on large prompt files; use the
+# libyaml-backed loader when the C extension is available
+_SAFE_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+@lru_cache(maxsize=None)
+def _load_prompts_cached(path: str, mtime: float) -> Dict:
+    with open(path, "r") as f:
+        return yaml.load(f, Loader=_SAFE_LOADER)
+
+
+def load_prompts(path: str) -> Dict:
+    """
+    Loads a YAML prompt file, reusing the parsed result across components.
+
+    The cache key includes the file mtime, so an edited prompt file is
+    re-parsed on the next load instead of serving stale prompts.
+
+    Args:
+        path (str): Path to the YAML prompt file.
+
+    Returns:
+        Dict: Parsed prompt sections.
+    """
+    return _load_prompts_cached(path, os.path.getmtime(path))